@@ -175,9 +175,7 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
         stop_gts = tf.expand_dims(
             tf.range(tf.reduce_max(max_mel_length), dtype=tf.int32), 0
         )  # [1, max_len]
-        stop_gts = tf.tile(
-            stop_gts, [tf.shape(batch["mel_lengths"])[0], 1]
-        )  # [B, max_len]
+        # greater_equal broadcasts [1, max_len] against [B, 1] to [B, max_len].
         stop_gts = tf.cast(
             tf.math.greater_equal(stop_gts, tf.expand_dims(batch["mel_lengths"], 1)),
             tf.float32,
@@ -349,8 +347,10 @@ def main():
     )
     args = parser.parse_args()
 
-    # return strategy
-    STRATEGY = return_strategy()
+    # return strategy, all-reduce gradients with NCCL packed into 2 buckets.
+    STRATEGY = return_strategy(
+        cross_device_ops=tf.distribute.NcclAllReduce(num_packs=2)
+    )
 
     # set mixed precision config
     if args.mixed_precision == 1:
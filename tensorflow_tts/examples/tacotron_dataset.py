@@ -42,9 +42,10 @@ class CharactorMelDataset(AbstractDataset):
         reduction_factor=1,
         mel_pad_value=0.0,
         char_pad_value=0,
-        ga_pad_value=-1.0,
+        ga_pad_value=0.0,
         g=0.2,
         use_fixed_shapes=False,
+        bucket_boundaries=None,
     ):
         """Initialize dataset.
 
@@ -59,11 +60,15 @@ class CharactorMelDataset(AbstractDataset):
             reduction_factor (int): Reduction factor on Tacotron-2 paper.
             mel_pad_value (float): Padding value for mel-spectrogram.
             char_pad_value (int): Padding value for charactor.
-            ga_pad_value (float): Padding value for guided attention.
+            ga_pad_value (float): Padding value for guided attention. Keep 0.0 for
+                Tacotron2Trainer, padded positions are not masked in its loss.
             g (float): G value for guided attention.
             use_fixed_shapes (bool): Use fixed shape for mel targets or not.
             max_char_length (int): maximum charactor length if use_fixed_shapes=True.
             max_mel_length (int): maximum mel length if use_fixed_shapes=True
+            bucket_boundaries (list): mel length boundaries to bucket batches if use_fixed_shapes=False.
+                If None, samples are batched with a plain padded_batch.
+                With drop_remainder, the last partial batch of each bucket is dropped.
 
         """
         # find all of charactor and mel files.
@@ -111,6 +116,7 @@ class CharactorMelDataset(AbstractDataset):
         self.ga_pad_value = ga_pad_value
         self.g = g
         self.use_fixed_shapes = use_fixed_shapes
+        self.bucket_boundaries = bucket_boundaries
         self.max_char_length = np.max(char_lengths)
 
         if np.max(mel_lengths) % self.reduction_factor == 0:
@@ -173,6 +179,8 @@ class CharactorMelDataset(AbstractDataset):
             "mel_lengths": mel_length,
             "real_mel_lengths": real_mel_length,
             "g_attentions": g_att,
+            # stop token targets, padded frames are filled with 1.
+            "stop_gts": tf.zeros([mel_length], tf.uint8),
         }
 
         return items
@@ -198,7 +206,12 @@ class CharactorMelDataset(AbstractDataset):
         reshuffle_each_iteration=True,
         drop_remainder=True,
     ):
-        """Create tf.dataset function."""
+        """Create tf.dataset function.
+
+        Besides the model inputs, each batch has `g_attentions`, padded with
+        ga_pad_value, and `stop_gts`, the uint8 stop token targets which are 1
+        on the padded frames (`range(T) >= mel_lengths`).
+        """
         output_types = self.get_output_dtypes()
         datasets = tf.data.Dataset.from_generator(
             self.generator, output_types=output_types, args=(self.get_args())
@@ -239,6 +252,7 @@ class CharactorMelDataset(AbstractDataset):
             "mel_lengths": 0,
             "real_mel_lengths": 0,
             "g_attentions": self.ga_pad_value,
+            "stop_gts": tf.constant(1, tf.uint8),
         }
 
         # define padded shapes.
@@ -257,14 +271,33 @@ class CharactorMelDataset(AbstractDataset):
             "g_attentions": [None, None]
             if self.use_fixed_shapes is False
             else [self.max_char_length, self.max_mel_length // self.reduction_factor],
+            "stop_gts": [None]
+            if self.use_fixed_shapes is False
+            else [self.max_mel_length],
         }
 
-        datasets = datasets.padded_batch(
-            batch_size,
-            padded_shapes=padded_shapes,
-            padding_values=padding_values,
-            drop_remainder=drop_remainder,
-        )
+        if self.use_fixed_shapes is False and self.bucket_boundaries is not None:
+            # batch samples with similar mel lengths together to reduce padding.
+            # drop_remainder applies to every bucket, so up to one batch per
+            # bucket is dropped; evaluation should pass drop_remainder=False.
+            bucket_batch_sizes = [batch_size] * (len(self.bucket_boundaries) + 1)
+            datasets = datasets.apply(
+                tf.data.experimental.bucket_by_sequence_length(
+                    element_length_func=lambda x: x["mel_lengths"],
+                    bucket_boundaries=self.bucket_boundaries,
+                    bucket_batch_sizes=bucket_batch_sizes,
+                    padded_shapes=padded_shapes,
+                    padding_values=padding_values,
+                    drop_remainder=drop_remainder,
+                )
+            )
+        else:
+            datasets = datasets.padded_batch(
+                batch_size,
+                padded_shapes=padded_shapes,
+                padding_values=padding_values,
+                drop_remainder=drop_remainder,
+            )
         datasets = datasets.prefetch(tf.data.experimental.AUTOTUNE)
         return datasets
 
@@ -24,10 +24,11 @@ import sys
 sys.path.append(".")
 
 import argparse
+import concurrent.futures
 import logging
 import os
+import threading
 
-import numpy as np
 import yaml
 from tqdm import tqdm
 
@@ -57,7 +58,13 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
             steps (int): Initial global steps.
             epochs (int): Initial global epochs.
             config (dict): Config dict loaded from yaml format configuration file.
-            is_mixed_precision (bool): Use mixed precision or not.
+            is_mixed_precision (bool): Use mixed precision or not. The optimizer
+                is wrapped with dynamic loss scaling, the float16 graph rewrite
+                is a process-wide option so the caller MUST enable it with
+                `tf.config.optimizer.set_experimental_options({"auto_mixed_precision": True})`
+                like examples/tacotron2/train_tacotron2.py does. The keras
+                mixed_float16 policy can not be used, the decoder cell builds
+                its states and alignment TensorArray in float32.
 
         """
         super(Tacotron2Trainer, self).__init__(
@@ -80,27 +87,100 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
 
         self.config = config
 
+        # the decoder loop can not be compiled by XLA (dynamic_decode without
+        # maximum_iterations), so we only compile the losses.
+        self._xla_compute_per_example_losses = tf.function(
+            self._compute_per_example_losses, jit_compile=True
+        )
+
+        # save intermediate result figures in background threads, at most
+        # 8 jobs are pending so the queued predictions stay bounded. The pool
+        # is created on the first job and shut down at the end of run().
+        self._plot_pool = None
+        self._plot_slots = threading.BoundedSemaphore(8)
+
+    def set_optimizer(self, optimizer):
+        """Set optimizer, wrap it with dynamic loss scaling for mixed precision.
+
+        The loss scale starts at 2**15, is halved and the update skipped when
+        the gradients overflow, and is doubled after 2000 finite steps.
+        """
+        self._optimizer = optimizer
+        if self._is_mixed_precision:
+            self._optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+                self._optimizer,
+                dynamic=True,
+                initial_scale=2.0 ** 15,
+                dynamic_growth_steps=2000,
+            )
+
     def compile(self, model, optimizer):
         super().compile(model, optimizer)
-        self.binary_crossentropy = tf.keras.losses.BinaryCrossentropy(
-            from_logits=True, reduction=tf.keras.losses.Reduction.NONE
-        )
-        self.mse = tf.keras.losses.MeanSquaredError(
-            reduction=tf.keras.losses.Reduction.NONE
-        )
-        self.mae = tf.keras.losses.MeanAbsoluteError(
-            reduction=tf.keras.losses.Reduction.NONE
-        )
+        # positional arguments of TFTacotron2.call.
+        self._model_arg_order = [
+            "input_ids",
+            "input_lengths",
+            "speaker_ids",
+            "mel_gts",
+            "mel_lengths",
+        ]
+
+    def run(self):
+        """Run training and wait for the pending intermediate results."""
+        try:
+            super().run()
+        finally:
+            self.wait_plot_jobs()
+
+    def wait_plot_jobs(self):
+        """Wait for the pending intermediate results and shut down the pool."""
+        if self._plot_pool is not None:
+            self._plot_pool.shutdown(wait=True)
+            self._plot_pool = None
+
+    def _submit_plot_job(self, fn, *args):
+        """Run fn(*args) in the plot pool, block while too many are pending."""
+        self._plot_slots.acquire()
+        try:
+            if self._plot_pool is None:
+                self._plot_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=4
+                )
+            future = self._plot_pool.submit(fn, *args)
+        except Exception:
+            self._plot_slots.release()
+            raise
+        future.add_done_callback(self._plot_job_done)
+
+    def _plot_job_done(self, future):
+        """Release the job slot and log the error of a failed job."""
+        self._plot_slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(
+                "Failed to save intermediate result.", exc_info=future.exception()
+            )
 
     def _train_step(self, batch):
-        """Here we re-define _train_step because apply input_signature make
-        the training progress slower on my experiment. Note that input_signature
-        is apply on based_trainer by default.
+        """Here we re-define _train_step because based_trainer always apply
+        input_signature, which make the training progress slower on my experiment
+        when the batch shapes change every step.
+
+        When use_fixed_shapes is True, every training batch has the same padded
+        shapes so we apply the train element signature and only one graph
+        is traced for the whole training. Otherwise one_step_forward is traced
+        with relaxed shapes. Evaluation dataset never use fixed shapes so
+        evaluate/predict functions are always relaxed.
         """
         if self._already_apply_input_signature is False:
-            self.one_step_forward = tf.function(
-                self._one_step_forward, experimental_relax_shapes=True
-            )
+            if self.config["use_fixed_shapes"]:
+                self.one_step_forward = tf.function(
+                    self._one_step_forward,
+                    input_signature=[self._get_train_element_signature()],
+                )
+            else:
+                self.one_step_forward = tf.function(
+                    self._one_step_forward, experimental_relax_shapes=True
+                )
             self.one_step_evaluate = tf.function(
                 self._one_step_evaluate, experimental_relax_shapes=True
             )
@@ -124,7 +204,8 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
         So we need pass `training=True` for inference step.
 
         """
-        outputs = self._model(**batch, training=True)
+        args = tuple(batch[k] for k in self._model_arg_order)
+        outputs = self._model(*args, training=True)
         _, dict_metrics_losses = self.compute_per_example_losses(batch, outputs)
 
         self.update_eval_metrics(dict_metrics_losses)
@@ -136,7 +217,8 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
         So we need pass `training=True` for inference step.
 
         """
-        outputs = self._model(**batch, training=True)
+        args = tuple(batch[k] for k in self._model_arg_order)
+        outputs = self._model(*args, training=True)
         return outputs
 
     def compute_per_example_losses(self, batch, outputs):
@@ -145,13 +227,38 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
         the keys of dict_metrics_losses MUST be in self.list_metrics_name.
 
         Args:
-            batch: dictionary batch input return from dataloader
+            batch: dictionary batch input return from dataloader, besides the
+                model inputs it MUST have `g_attentions` (padded with 0.0) and
+                `stop_gts` (uint8, 1 from mel_lengths onwards), see
+                CharactorMelDataset.
             outputs: outputs of the model
 
         Returns:
             per_example_losses: per example losses for each GPU, shape [B]
             dict_metrics_losses: dictionary loss.
         """
+        # utt_ids is a string tensor and can not be fed to a XLA cluster.
+        loss_batch = {
+            k: batch[k]
+            for k in [
+                "input_lengths",
+                "mel_gts",
+                "mel_lengths",
+                "stop_gts",
+                "g_attentions",
+            ]
+        }
+
+        # XLA is only used with static shapes (use_fixed_shapes), otherwise
+        # it would re-compile for every new batch shape.
+        if (
+            self.config["use_fixed_shapes"]
+            and batch["mel_gts"].shape.is_fully_defined()
+        ):
+            return self._xla_compute_per_example_losses(loss_batch, outputs)
+        return self._compute_per_example_losses(loss_batch, outputs)
+
+    def _compute_per_example_losses(self, batch, outputs):
         (
             decoder_output,
             post_mel_outputs,
@@ -159,43 +266,46 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
             alignment_historys,
         ) = outputs
 
+        def _absolute_error(y_gt, y_pred):
+            return tf.abs(y_gt - y_pred)
+
+        # calculate_3d_loss averages the absolute error over [T, 80] in one
+        # reduction, shape [B].
         mel_loss_before = calculate_3d_loss(
-            batch["mel_gts"], decoder_output, loss_fn=self.mae
+            batch["mel_gts"], decoder_output, loss_fn=_absolute_error
         )
         mel_loss_after = calculate_3d_loss(
-            batch["mel_gts"], post_mel_outputs, loss_fn=self.mae
+            batch["mel_gts"], post_mel_outputs, loss_fn=_absolute_error
         )
 
-        # calculate stop_loss
-        max_mel_length = (
-            tf.reduce_max(batch["mel_lengths"])
-            if self.config["use_fixed_shapes"] is False
-            else [self.config["max_mel_length"]]
-        )
-        stop_gts = tf.expand_dims(
-            tf.range(tf.reduce_max(max_mel_length), dtype=tf.int32), 0
-        )  # [1, max_len]
-        stop_gts = tf.tile(
-            stop_gts, [tf.shape(batch["mel_lengths"])[0], 1]
-        )  # [B, max_len]
-        stop_gts = tf.cast(
-            tf.math.greater_equal(stop_gts, tf.expand_dims(batch["mel_lengths"], 1)),
-            tf.float32,
-        )
+        # calculate stop_loss, stop_gts is built by the dataloader.
+        stop_gts = tf.cast(batch["stop_gts"], tf.float32)  # [B, max_len]
 
+        # calculate_2d_loss reduces the [B, max_len] cross entropy over time.
         stop_token_loss = calculate_2d_loss(
-            stop_gts, stop_token_predictions, loss_fn=self.binary_crossentropy
+            stop_gts,
+            stop_token_predictions,
+            loss_fn=lambda labels, logits: tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=labels, logits=logits
+            ),
         )
 
-        # calculate guided attention loss.
-        attention_masks = tf.cast(
-            tf.math.not_equal(batch["g_attentions"], -1.0), tf.float32
+        # calculate guided attention loss, g_attentions are padded with 0.0
+        # so only the valid [input_lengths, mel_lengths // r] positions count.
+        n_valid_positions = tf.cast(
+            batch["input_lengths"]
+            * (
+                batch["mel_lengths"]
+                // self.config["tacotron2_params"]["reduction_factor"]
+            ),
+            alignment_historys.dtype,
         )
-        loss_att = tf.reduce_sum(
-            tf.abs(alignment_historys * batch["g_attentions"]) * attention_masks,
-            axis=[1, 2],
-        )
-        loss_att /= tf.reduce_sum(attention_masks, axis=[1, 2])
+        loss_att = tf.math.divide_no_nan(
+            tf.reduce_sum(
+                tf.abs(alignment_historys * batch["g_attentions"]), axis=[1, 2]
+            ),
+            n_valid_positions,
+        )  # fully padded samples get 0.0 instead of NaN.
 
         per_example_losses = (
             stop_token_loss + mel_loss_before + mel_loss_after + loss_att
@@ -212,7 +322,9 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
 
     def generate_and_save_intermediate_result(self, batch):
         """Generate and save intermediate result."""
-        import matplotlib.pyplot as plt
+        # only the chief worker saves intermediate results.
+        if not self._strategy.extended.should_checkpoint:
+            return
 
         # predict with tf.function for faster.
         outputs = self.one_step_predict(batch)
@@ -222,9 +334,35 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
             stop_token_predictions,
             alignment_historys,
         ) = outputs
-        mel_gts = batch["mel_gts"]
-        utt_ids = batch["utt_ids"]
 
+        # check directory
+        dirname = os.path.join(self.config["outdir"], f"predictions/{self.steps}steps")
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # copy to host in background so the training thread is not blocked.
+        self._submit_plot_job(
+            self._save_intermediate_result,
+            dirname,
+            decoder_output,
+            mel_outputs,
+            batch["mel_gts"],
+            alignment_historys,
+            batch["utt_ids"],
+            self.steps,
+        )
+
+    def _save_intermediate_result(
+        self,
+        dirname,
+        decoder_output,
+        mel_outputs,
+        mel_gts,
+        alignment_historys,
+        utt_ids,
+        steps,
+    ):
+        """Convert the predictions to numpy and plot every sample."""
         # convert to tensor.
         # here we just take a sample at first replica.
         try:
@@ -240,52 +378,78 @@ class Tacotron2Trainer(Seq2SeqBasedTrainer):
             alignment_historys = alignment_historys.numpy()
             utt_ids = utt_ids.numpy()
 
-        # check directory
-        dirname = os.path.join(self.config["outdir"], f"predictions/{self.steps}steps")
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        # reshape all samples to [B, length, 80] at once.
+        mels_before = mels_before.reshape(mels_before.shape[0], -1, 80)
+        mels_after = mels_after.reshape(mels_after.shape[0], -1, 80)
+        mel_gts = mel_gts.reshape(mel_gts.shape[0], -1, 80)
 
         for idx, (mel_gt, mel_before, mel_after, alignment_history) in enumerate(
             zip(mel_gts, mels_before, mels_after, alignment_historys), 0
         ):
-            mel_gt = tf.reshape(mel_gt, (-1, 80)).numpy()  # [length, 80]
-            mel_before = tf.reshape(mel_before, (-1, 80)).numpy()  # [length, 80]
-            mel_after = tf.reshape(mel_after, (-1, 80)).numpy()  # [length, 80]
-
-            # plot figure and save it
+            # this already runs in the plot pool, so plot inline. The figures
+            # are created here so they are never shared between threads.
             utt_id = utt_ids[idx]
-            figname = os.path.join(dirname, f"{utt_id}.png")
-            fig = plt.figure(figsize=(10, 8))
-            ax1 = fig.add_subplot(311)
-            ax2 = fig.add_subplot(312)
-            ax3 = fig.add_subplot(313)
-            im = ax1.imshow(np.rot90(mel_gt), aspect="auto", interpolation="none")
-            ax1.set_title("Target Mel-Spectrogram")
-            fig.colorbar(mappable=im, shrink=0.65, orientation="horizontal", ax=ax1)
-            ax2.set_title(f"Predicted Mel-before-Spectrogram @ {self.steps} steps")
-            im = ax2.imshow(np.rot90(mel_before), aspect="auto", interpolation="none")
-            fig.colorbar(mappable=im, shrink=0.65, orientation="horizontal", ax=ax2)
-            ax3.set_title(f"Predicted Mel-after-Spectrogram @ {self.steps} steps")
-            im = ax3.imshow(np.rot90(mel_after), aspect="auto", interpolation="none")
-            fig.colorbar(mappable=im, shrink=0.65, orientation="horizontal", ax=ax3)
-            plt.tight_layout()
-            plt.savefig(figname)
-            plt.close()
-
-            # plot alignment
-            figname = os.path.join(dirname, f"{idx}_alignment.png")
-            fig = plt.figure(figsize=(8, 6))
-            ax = fig.add_subplot(111)
-            ax.set_title(f"Alignment @ {self.steps} steps")
-            im = ax.imshow(
-                alignment_history, aspect="auto", origin="lower", interpolation="none"
+            self._save_mel_figure(
+                os.path.join(dirname, f"{utt_id}.png"),
+                mel_gt,
+                mel_before,
+                mel_after,
+                steps,
+            )
+            self._save_alignment_figure(
+                os.path.join(dirname, f"{idx}_alignment.png"), alignment_history, steps
             )
-            fig.colorbar(im, ax=ax)
-            xlabel = "Decoder timestep"
-            plt.xlabel(xlabel)
-            plt.ylabel("Encoder timestep")
-            plt.tight_layout()
-            plt.savefig(figname)
-            plt.close()
 
+    def _save_mel_figure(self, figname, mel_gt, mel_before, mel_after, steps):
+        """Plot target and predicted mel-spectrograms and save the figure."""
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=(10, 8), constrained_layout=True)
+        ax1 = fig.add_subplot(311)
+        ax2 = fig.add_subplot(312)
+        ax3 = fig.add_subplot(313)
+        # all mels share the same color scale so one colorbar is enough.
+        vmin = min(mel_gt.min(), mel_before.min(), mel_after.min())
+        vmax = max(mel_gt.max(), mel_before.max(), mel_after.max())
+        # mel.T[::-1] is np.rot90(mel) as a view, without copy.
+        ax1.imshow(
+            mel_gt.T[::-1], aspect="auto", interpolation="none", vmin=vmin, vmax=vmax
+        )
+        ax1.set_title("Target Mel-Spectrogram")
+        ax2.set_title(f"Predicted Mel-before-Spectrogram @ {steps} steps")
+        ax2.imshow(
+            mel_before.T[::-1],
+            aspect="auto",
+            interpolation="none",
+            vmin=vmin,
+            vmax=vmax,
+        )
+        ax3.set_title(f"Predicted Mel-after-Spectrogram @ {steps} steps")
+        im = ax3.imshow(
+            mel_after.T[::-1],
+            aspect="auto",
+            interpolation="none",
+            vmin=vmin,
+            vmax=vmax,
+        )
+        fig.colorbar(
+            mappable=im, shrink=0.65, orientation="horizontal", ax=[ax1, ax2, ax3]
+        )
+        fig.savefig(figname)
+
+    def _save_alignment_figure(self, figname, alignment_history, steps):
+        """Plot alignment and save the figure."""
+        from matplotlib.figure import Figure
 
+        fig = Figure(figsize=(8, 6))
+        ax = fig.add_subplot(111)
+        ax.set_title(f"Alignment @ {steps} steps")
+        im = ax.imshow(
+            alignment_history, aspect="auto", origin="lower", interpolation="none"
+        )
+        fig.colorbar(im, ax=ax)
+        xlabel = "Decoder timestep"
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel("Encoder timestep")
+        fig.tight_layout()
+        fig.savefig(figname)
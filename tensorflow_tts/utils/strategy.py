@@ -16,14 +16,21 @@
 import tensorflow as tf
 
 
-def return_strategy():
+def return_strategy(cross_device_ops=None):
+    """Return distribute strategy.
+
+    Args:
+        cross_device_ops (tf.distribute.CrossDeviceOps): all-reduce used by
+            MirroredStrategy on multi-GPU. If None, MirroredStrategy picks one
+            itself (and falls back when NCCL is not available).
+    """
     physical_devices = tf.config.list_physical_devices("GPU")
     if len(physical_devices) == 0:
         return tf.distribute.OneDeviceStrategy(device="/cpu:0")
     elif len(physical_devices) == 1:
         return tf.distribute.OneDeviceStrategy(device="/gpu:0")
     else:
-        return tf.distribute.MirroredStrategy()
+        return tf.distribute.MirroredStrategy(cross_device_ops=cross_device_ops)
 
 
 def calculate_3d_loss(y_gt, y_pred, loss_fn):
@@ -34,10 +41,10 @@ def calculate_3d_loss(y_gt, y_pred, loss_fn):
     # there is a mismath length when training multiple GPU.
     # we need slice the longer tensor to make sure the loss
     # calculated correctly.
-    if y_gt_T > y_pred_T:
-        y_gt = tf.slice(y_gt, [0, 0, 0], [-1, y_pred_T, -1])
-    elif y_pred_T > y_gt_T:
-        y_pred = tf.slice(y_pred, [0, 0, 0], [-1, y_gt_T, -1])
+    # slice both without branch so it also can be compiled by XLA.
+    min_T = tf.minimum(y_gt_T, y_pred_T)
+    y_gt = tf.slice(y_gt, [0, 0, 0], [-1, min_T, -1])
+    y_pred = tf.slice(y_pred, [0, 0, 0], [-1, min_T, -1])
 
     loss = loss_fn(y_gt, y_pred)
     if isinstance(loss, tuple) is False:
@@ -59,10 +66,10 @@ def calculate_2d_loss(y_gt, y_pred, loss_fn):
     # there is a mismath length when training multiple GPU.
     # we need slice the longer tensor to make sure the loss
     # calculated correctly.
-    if y_gt_T > y_pred_T:
-        y_gt = tf.slice(y_gt, [0, 0], [-1, y_pred_T])
-    elif y_pred_T > y_gt_T:
-        y_pred = tf.slice(y_pred, [0, 0], [-1, y_gt_T])
+    # slice both without branch so it also can be compiled by XLA.
+    min_T = tf.minimum(y_gt_T, y_pred_T)
+    y_gt = tf.slice(y_gt, [0, 0], [-1, min_T])
+    y_pred = tf.slice(y_pred, [0, 0], [-1, min_T])
 
     loss = loss_fn(y_gt, y_pred)
     if isinstance(loss, tuple) is False:
@@ -24,9 +24,14 @@ import tensorflow as tf
 
 from tensorflow_tts.configs import Tacotron2Config
 from tensorflow_tts.models import TFTacotron2
+from tensorflow_tts.optimizers import AdamWeightDecay
 from tensorflow_tts.utils import return_strategy
 
 from examples.tacotron2.train_tacotron2 import Tacotron2Trainer
+from tensorflow_tts.examples.tacotron_dataset import CharactorMelDataset
+from tensorflow_tts.examples.train_tacotron2 import (
+    Tacotron2Trainer as PackagedTacotron2Trainer,
+)
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
@@ -147,3 +152,259 @@ def test_tacotron2_trainable(
     total_runtime = time.time() - start
     print(f" > Total run-time: {total_runtime}")
     print(f" > Avg run-time: {total_runtime/10}")
+
+
+def _create_packaged_trainer(
+    tmp_path, batch_size, use_fixed_shapes=False, is_mixed_precision=False
+):
+    """Create and compile the packaged Tacotron2Trainer with a small model."""
+    with open("./tensorflow_tts/examples/config/tacotron2.v1.yaml") as f:
+        config = yaml.load(f, Loader=yaml.Loader)
+
+    config.update({"outdir": str(tmp_path)})
+    config.update({"batch_size": batch_size})
+    config.update({"use_fixed_shapes": use_fixed_shapes})
+
+    STRATEGY = return_strategy()
+
+    trainer = PackagedTacotron2Trainer(
+        config=config,
+        strategy=STRATEGY,
+        steps=0,
+        epochs=0,
+        is_mixed_precision=is_mixed_precision,
+    )
+
+    with STRATEGY.scope():
+        model = TFTacotron2(
+            Tacotron2Config(n_speakers=1, reduction_factor=1), name="tacotron2"
+        )
+        model._build()
+        optimizer = AdamWeightDecay(learning_rate=0.001)
+
+    trainer.compile(model, optimizer)
+    return trainer
+
+
+def _create_fake_batch(batch_size, max_input_length, max_mel_length):
+    """Create a batch with the keys returned by CharactorMelDataset."""
+    mel_lengths = tf.constant([max_mel_length] * batch_size, tf.int32)
+    return {
+        "utt_ids": tf.constant([f"{i}" for i in range(batch_size)]),
+        "input_ids": tf.random.uniform(
+            [batch_size, max_input_length], maxval=10, dtype=tf.int32
+        ),
+        "input_lengths": tf.constant([max_input_length] * batch_size, tf.int32),
+        "speaker_ids": tf.zeros([batch_size], tf.int32),
+        "mel_gts": tf.random.uniform([batch_size, max_mel_length, 80]),
+        "mel_lengths": mel_lengths,
+        "real_mel_lengths": mel_lengths,
+        "g_attentions": tf.random.uniform(
+            [batch_size, max_input_length, max_mel_length]
+        ),
+        "stop_gts": tf.zeros([batch_size, max_mel_length], tf.uint8),
+    }
+
+
+@pytest.mark.parametrize(
+    "batch_size, max_input_length, max_mel_length", [(2, 10, 20),],
+)
+def test_tacotron2_trainer_loss_scale_optimizer_step(
+    batch_size, max_input_length, max_mel_length, tmp_path
+):
+    trainer = _create_packaged_trainer(tmp_path, batch_size, is_mixed_precision=True)
+    batch = _create_fake_batch(batch_size, max_input_length, max_mel_length)
+
+    # the auto_mixed_precision graph rewrite is skipped by grappler without a
+    # GPU, so this only covers the dynamic loss scaling of the train step.
+    optimizer = trainer.get_optimizer()
+    assert isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+    assert optimizer.dynamic
+    assert optimizer.initial_scale == 2.0 ** 15
+    assert optimizer.dynamic_growth_steps == 2000
+
+    loss = tf.function(trainer._one_step_forward)(batch)
+
+    assert np.isfinite(loss.numpy())
+    # gradients are finite, the scale is only grown after 2000 steps.
+    assert optimizer.loss_scale.numpy() == 2.0 ** 15
+
+
+@pytest.mark.parametrize(
+    "batch_size, max_input_length, max_mel_length", [(2, 10, 20),],
+)
+def test_tacotron2_trainer_evaluate_step(
+    batch_size, max_input_length, max_mel_length, tmp_path
+):
+    trainer = _create_packaged_trainer(tmp_path, batch_size)
+    batch = _create_fake_batch(batch_size, max_input_length, max_mel_length)
+
+    tf.function(trainer._one_step_evaluate, experimental_relax_shapes=True)(batch)
+
+    for key in trainer.list_metrics_name:
+        # per example losses, so one update per sample.
+        assert trainer.eval_metrics[key].count.numpy() == batch_size
+        assert np.isfinite(trainer.eval_metrics[key].result().numpy())
+
+
+@pytest.mark.parametrize(
+    "batch_size, max_input_length, max_mel_length", [(2, 10, 20),],
+)
+def test_tacotron2_trainer_xla_losses(
+    batch_size, max_input_length, max_mel_length, tmp_path
+):
+    trainer = _create_packaged_trainer(tmp_path, batch_size, use_fixed_shapes=True)
+    batch = _create_fake_batch(batch_size, max_input_length, max_mel_length)
+    args = tuple(batch[k] for k in trainer._model_arg_order)
+    outputs = trainer._model(*args, training=True)
+
+    # static shapes with use_fixed_shapes, the losses go through XLA.
+    xla_losses, xla_dict_losses = trainer.compute_per_example_losses(batch, outputs)
+    assert trainer._xla_compute_per_example_losses.experimental_get_tracing_count() == 1
+
+    losses, dict_losses = trainer._compute_per_example_losses(batch, outputs)
+    np.testing.assert_allclose(xla_losses.numpy(), losses.numpy(), rtol=1e-5)
+    for key in trainer.list_metrics_name:
+        assert xla_dict_losses[key].shape == [batch_size]
+        np.testing.assert_allclose(
+            xla_dict_losses[key].numpy(), dict_losses[key].numpy(), rtol=1e-5
+        )
+
+
+@pytest.mark.parametrize(
+    "batch_size, max_input_length, max_mel_length", [(2, 10, 20),],
+)
+def test_tacotron2_trainer_save_intermediate_result(
+    batch_size, max_input_length, max_mel_length, tmp_path
+):
+    trainer = _create_packaged_trainer(tmp_path, batch_size)
+    batch = _create_fake_batch(batch_size, max_input_length, max_mel_length)
+    trainer.one_step_predict = tf.function(
+        trainer._one_step_predict, experimental_relax_shapes=True
+    )
+
+    # the pool is shut down after each wait and must be usable again.
+    for steps in [1, 2]:
+        trainer.steps = steps
+        trainer.generate_and_save_intermediate_result(batch)
+        trainer.wait_plot_jobs()
+
+        dirname = os.path.join(str(tmp_path), f"predictions/{steps}steps")
+        for idx, utt_id in enumerate(batch["utt_ids"].numpy()):
+            assert os.path.isfile(os.path.join(dirname, f"{utt_id}.png"))
+            assert os.path.isfile(os.path.join(dirname, f"{idx}_alignment.png"))
+
+
+def _write_toy_dataset(root_dir, mel_lengths, char_lengths, with_alignments=False):
+    """Write dumped ids/feats (and FAL alignments) files into root_dir."""
+    for i, (mel_length, char_length) in enumerate(zip(mel_lengths, char_lengths)):
+        utt_id = os.path.join(str(root_dir), f"utt{i}")
+        ids = np.random.randint(1, 10, size=[char_length]).astype(np.int32)
+        mel = np.random.rand(mel_length, 80).astype(np.float32)
+        np.save(f"{utt_id}-ids.npy", ids)
+        np.save(f"{utt_id}-norm-feats.npy", mel)
+        if with_alignments:
+            alignment = np.random.randint(0, 2, size=[char_length, mel_length])
+            np.save(f"{utt_id}-alignment.npy", alignment.astype(np.float32))
+
+
+@pytest.mark.parametrize("use_fixed_shapes", [False, True])
+@pytest.mark.parametrize("with_alignments", [False, True])
+def test_tacotron2_dataset_guided_attention_padding(
+    use_fixed_shapes, with_alignments, tmp_path
+):
+    _write_toy_dataset(tmp_path, [12, 20, 15], [5, 9, 7], with_alignments)
+
+    def _create_dataset(ga_pad_value):
+        return CharactorMelDataset(
+            dataset="ljspeech",
+            root_dir=str(tmp_path),
+            align_query="*-alignment.npy" if with_alignments else "",
+            ga_pad_value=ga_pad_value,
+            use_fixed_shapes=use_fixed_shapes,
+        ).create(batch_size=2, drop_remainder=False)
+
+    n_batches = 0
+    for batch, old_batch in zip(_create_dataset(0.0), _create_dataset(-1.0)):
+        n_batches += 1
+        old_masks = tf.cast(
+            tf.math.not_equal(old_batch["g_attentions"], -1.0), tf.float32
+        )
+        # the trainer denominator matches the old not_equal(g_attentions, -1.0) mask.
+        np.testing.assert_array_equal(
+            (batch["input_lengths"] * batch["mel_lengths"]).numpy(),
+            tf.reduce_sum(old_masks, axis=[1, 2]).numpy(),
+        )
+        # padded positions are 0.0, so the numerator needs no mask.
+        np.testing.assert_array_equal(
+            batch["g_attentions"].numpy(),
+            (old_batch["g_attentions"] * old_masks).numpy(),
+        )
+    assert n_batches == 2
+
+
+@pytest.mark.parametrize("use_fixed_shapes", [False, True])
+def test_tacotron2_dataset_stop_gts(use_fixed_shapes, tmp_path):
+    _write_toy_dataset(tmp_path, [12, 20, 15], [5, 9, 7])
+    dataset = CharactorMelDataset(
+        dataset="ljspeech",
+        root_dir=str(tmp_path),
+        use_fixed_shapes=use_fixed_shapes,
+    )
+
+    n_batches = 0
+    for batch in dataset.create(batch_size=2, drop_remainder=False):
+        n_batches += 1
+        mel_lengths = batch["mel_lengths"]
+        max_mel_length = (
+            dataset.max_mel_length if use_fixed_shapes else tf.reduce_max(mel_lengths)
+        )
+        expected = tf.cast(
+            tf.greater_equal(
+                tf.range(max_mel_length, dtype=mel_lengths.dtype)[None, :],
+                tf.expand_dims(mel_lengths, 1),
+            ),
+            tf.uint8,
+        )
+        assert batch["stop_gts"].dtype == tf.uint8
+        np.testing.assert_array_equal(batch["stop_gts"].numpy(), expected.numpy())
+    assert n_batches == 2
+
+
+@pytest.mark.parametrize(
+    "bucket_boundaries, drop_remainder, expected_batch_sizes",
+    [
+        (None, False, [2, 2, 1]),
+        (None, True, [2, 2]),
+        ([10], False, [2, 1, 2]),
+        ([10], True, [2, 2]),
+    ],
+)
+def test_tacotron2_dataset_bucket_batches(
+    bucket_boundaries, drop_remainder, expected_batch_sizes, tmp_path
+):
+    mel_lengths = [5, 15, 6, 16, 7]
+    _write_toy_dataset(tmp_path, mel_lengths, [3, 3, 3, 3, 3])
+    dataset = CharactorMelDataset(
+        dataset="ljspeech",
+        root_dir=str(tmp_path),
+        bucket_boundaries=bucket_boundaries,
+    ).create(batch_size=2, drop_remainder=drop_remainder)
+
+    batch_sizes = []
+    seen_mel_lengths = []
+    for batch in dataset:
+        batch_mel_lengths = batch["mel_lengths"].numpy()
+        batch_sizes.append(len(batch_mel_lengths))
+        seen_mel_lengths.extend(batch_mel_lengths)
+        assert batch["mel_gts"].shape[1] == max(batch_mel_lengths)
+        assert batch["stop_gts"].shape[1] == max(batch_mel_lengths)
+        if bucket_boundaries is not None:
+            # all samples of a batch lie in the same bucket.
+            assert len(set(np.digitize(batch_mel_lengths, bucket_boundaries))) == 1
+
+    # only the partial batches are dropped, and only with drop_remainder.
+    assert sorted(batch_sizes) == sorted(expected_batch_sizes)
+    assert len(seen_mel_lengths) == sum(expected_batch_sizes)
+    if not drop_remainder:
+        assert sorted(seen_mel_lengths) == sorted(mel_lengths)